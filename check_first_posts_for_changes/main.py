@@ -12,10 +12,13 @@ import json
 import logging
 import difflib
 import hashlib
-import random
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import sqlalchemy
-# idea for optimization – to move to psycopg2
 
 from google.cloud import secretmanager
 from google.cloud import pubsub_v1
@@ -24,13 +27,48 @@ from google.cloud import pubsub_v1
 project_id = os.environ["GCP_PROJECT"]
 client = secretmanager.SecretManagerServiceClient()
 requests_session = requests.Session()
-publisher = pubsub_v1.PublisherClient()
-
-bad_gateway_counter = 0
-
-
+# keep-alive connections to the forum are shared by all the parallel requests,
+# 502/503/504 responses are retried with a backoff – the last response is returned as is if forum is still down,
+# read timeouts are not retried – not to exceed the timeout of the script
+requests_session.mount('https://lizaalert.org', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, read=0, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                      raise_on_status=False)))
+# messages are sent in batches, the script waits for all of them only once – in the end of main()
+publisher = pubsub_v1.PublisherClient(batch_settings=pubsub_v1.types.BatchSettings(max_messages=100,
+                                                                                  max_bytes=1024 * 1024,
+                                                                                  max_latency=0.1))
+publish_futures = []
+
+forum_topic_url = 'https://lizaalert.org/forum/viewtopic.php'
+# number of forum pages requested in parallel – the forum should not be overloaded,
+# should not exceed pool_maxsize of requests_session
+max_parallel_requests = 8
+
+# pattern to exclude dynamic info from the first post in one pass –
+# views of the pictures (the closing bracket is kept) and token / creation time / sid / footer
+pattern_dynamic_info = re.compile(r'(?<=\)) \d+ просмотр(?:а|ов)?'
+                                  r'|value="(?:\S{10}|\S{32}|\S{40})"'
+                                  r'|sid=\S{32}&amp;'
+                                  r'|<span class="footer-info"><span title="SQL time:.{120,130}</span></span>')
+
+# service messages of the forum, which are searched in the page content in one pass
+pattern_page_markers = re.compile(r'502 Bad Gateway|Bad Gateway|Запрошенной темы не существует'
+                                  r'|Для просмотра этого форума вы должны быть авторизованы')
+
+# patterns to get the search status out of the topic title
+pattern_pre_title = re.compile(r'<h2 class="topic-title"><a href=.{1,500}</a>')
+pattern_title = re.compile(r'">.{1,500}</a>')
+pattern_status_missed = re.compile(r'(?i).{0,10}пропал.*')
+pattern_status_alive = re.compile(r'(?i).{0,10}(?:найден|).{0,5}жив')
+pattern_status_dead = re.compile(r'(?i).{0,10}(?:найден|).{0,5}пог')
+pattern_status_finished = re.compile(r'(?i).{0,10}заверш.н')
+
+
+@functools.lru_cache(maxsize=None)
 def get_secrets(secret_request):
-    """get GCP secret"""
+    """get GCP secret, every secret is requested from Secret Manager only once per process"""
 
     name = f"projects/{project_id}/secrets/{secret_request}/versions/latest"
     response = client.access_secret_version(name=name)
@@ -38,8 +76,9 @@ def get_secrets(secret_request):
     return response.payload.data.decode("UTF-8")
 
 
+@functools.lru_cache(maxsize=1)
 def sql_connect():
-    """connect to PSQL in GCP"""
+    """connect to PSQL in GCP, the engine (and its pool) is created once and reused by all the calls"""
 
     db_user = get_secrets("cloud-postgres-username")
     db_pass = get_secrets("cloud-postgres-password")
@@ -56,19 +95,20 @@ def sql_connect():
 
     pool = sqlalchemy.create_engine(
         sqlalchemy.engine.url.URL(
-            "postgresql+pg8000",
+            "postgresql+psycopg2",
             username=db_user,
             password=db_pass,
             database=db_name,
             query={
-                "unix_sock": "{}/{}/.s.PGSQL.5432".format(
+                "host": "{}/{}".format(
                     db_socket_dir,
                     db_conn)
             }
         ),
+        # executemany is sent by psycopg2.extras.execute_batch / execute_values in pages, not row by row
+        executemany_mode="values_plus_batch",
         **db_config
     )
-    pool.dialect.description_encoding = None
 
     return pool
 
@@ -82,8 +122,8 @@ def publish_to_pubsub(topic_name, message):
 
     try:
         publish_future = publisher.publish(topic_path, data=message_bytes)
-        publish_future.result()  # Verify the publishing succeeded
-        logging.info(f'Sent pub/sub message: {message}')
+        # publishing is verified in wait_for_published_messages
+        publish_futures.append([publish_future, message])
 
     except Exception as e:
         logging.info(f'Not able to send pub/sub message: {message}')
@@ -92,6 +132,25 @@ def publish_to_pubsub(topic_name, message):
     return None
 
 
+def wait_for_published_messages():
+    """wait till all the pub/sub messages of the script are published"""
+
+    global publish_futures
+
+    for publish_future, message in publish_futures:
+        try:
+            publish_future.result()  # Verify the publishing succeeded
+            logging.info(f'Sent pub/sub message: {message}')
+
+        except Exception as e:
+            logging.info(f'Not able to send pub/sub message: {message}')
+            logging.exception(e)
+
+    publish_futures = []
+
+    return None
+
+
 def notify_admin(message):
     """send the pub/sub message to Debug to Admin"""
 
@@ -100,18 +159,20 @@ def notify_admin(message):
     return None
 
 
-def check_topic_visibility(search_num):
-    """check is the existing search was deleted or hidden"""
+def get_page_markers(content):
+    """get the set of forum service messages (bad gateway, not found, etc.) found in the page content"""
 
-    global bad_gateway_counter
+    return set(pattern_page_markers.findall(content))
+
+
+def check_topic_visibility(search_num, content):
+    """check is the existing search was deleted or hidden"""
 
     deleted_trigger = None
     hidden_trigger = None
     visibility = 'regular'
     bad_gateway = False
 
-    content = parse_search(search_num)
-
     if content:
 
         # TODO: temp check, if this "patch" can help to remove timeouts
@@ -122,22 +183,24 @@ def check_topic_visibility(search_num):
             notify_admin(f'content.find() > 0 is True for {search_num}. BadGateway = {bad_gateway}')
         # FIXME – end
 
+        markers = get_page_markers(content)
+
         # FIXME – below is a check if content.find('502 Bad Gateway') is a right format for bad_gateway
-        test_old__bad_gateway = True if content.find('Bad Gateway') > 0 else False
+        test_old__bad_gateway = bool(markers & {'502 Bad Gateway', 'Bad Gateway'})
         if test_old__bad_gateway:
             notify_admin(f'BadGateway for {search_num}, content[3000]:{content[3000]}')
         # FIXME – end
 
         if not bad_gateway:
 
-            if content.find('Запрошенной темы не существует.') > -1:
+            if 'Запрошенной темы не существует' in markers:
                 deleted_trigger = True
                 visibility = 'deleted'
 
             else:
                 deleted_trigger = False
 
-            if content.find('Для просмотра этого форума вы должны быть авторизованы') > -1:
+            if 'Для просмотра этого форума вы должны быть авторизованы' in markers:
                 hidden_trigger = True
                 visibility = 'hidden'
             else:
@@ -148,57 +211,64 @@ def check_topic_visibility(search_num):
     return deleted_trigger, hidden_trigger, bad_gateway, visibility
 
 
-def update_one_topic_visibility(search_id):
-    """update the status of one search: if it is ok or was deleted or hidden"""
+def get_one_topic_visibility(search_id, content):
+    """get the status of one search: if it is ok or was deleted or hidden, None for bad gateway"""
 
-    global bad_gateway_counter
-    global requests_session
-
-    del_trig, hid_trig, bad_gateway_trigger, visibility = check_topic_visibility(search_id)
+    del_trig, hid_trig, bad_gateway_trigger, visibility = check_topic_visibility(search_id, content)
 
     logging.info(f'{search_id}: visibility = {visibility}')
 
-    if not bad_gateway_trigger:
+    if bad_gateway_trigger:
+        return None
 
-        pool = sql_connect()
-        with pool.connect() as conn:
+    return visibility
 
-            try:
-                stmt = sqlalchemy.text("""DELETE FROM search_health_check WHERE search_forum_num=:a;""")
-                conn.execute(stmt, a=search_id)
 
-                stmt = sqlalchemy.text("""INSERT INTO search_health_check (search_forum_num, timestamp, status) 
-                                    VALUES (:a, :b, :c);""")
-                conn.execute(stmt, a=search_id, b=datetime.datetime.now(), c=visibility)
+def update_topics_visibility(list_of_visibilities):
+    """update the status of several searches in one batch: if they are ok or were deleted or hidden.
+    list_of_visibilities: [[search_id, visibility], ...]"""
 
-                logging.info('psql updated for {} status is set {}'.format(search_id, visibility))
-                logging.info('---------------')
+    if not list_of_visibilities:
+        return None
 
-            except Exception as e:
-                logging.info('exception in update_one_topic_visibility')
-                logging.exception(e)
+    with sql_connect().connect() as conn:
 
-            conn.close()
-        pool.dispose()
+        try:
+            # old records are deleted and new ones are inserted by one statement,
+            # statement starts with WITH – so SQLAlchemy should be told to commit it
+            stmt = sqlalchemy.text("""
+                WITH deleted AS (
+                    DELETE FROM search_health_check WHERE search_forum_num = ANY(:a)
+                )
+                INSERT INTO search_health_check (search_forum_num, timestamp, status) 
+                SELECT 
+                    v.search_forum_num, :b, v.status 
+                FROM 
+                    unnest(:a, :c) AS v (search_forum_num, status)
+                ;""").execution_options(autocommit=True)
+            conn.execute(stmt, a=[line[0] for line in list_of_visibilities], b=datetime.datetime.now(),
+                         c=[line[1] for line in list_of_visibilities])
 
-    else:
-        bad_gateway_counter += 1
-        logging.info('502: {} - {}'.format(str(search_id), bad_gateway_counter))
+            logging.info(f'psql updated for {len(list_of_visibilities)} searches: {list_of_visibilities}')
+            logging.info('---------------')
+
+        except Exception as e:
+            logging.info('exception in update_topics_visibility')
+            logging.exception(e)
 
     return None
 
 
 def update_visibility_for_list_of_active_searches(number_of_searches):
-    """update the status of all active searches if it was deleted of hidden"""
+    """update the status of all active searches if it was deleted of hidden, returns number of bad gateways"""
 
-    global bad_gateway_counter
-    global requests_session
+    bad_gateway_counter = 0
 
-    pool = sql_connect()
-    conn = pool.connect()
+    conn = sql_connect().connect()
 
     try:
-        full_list_of_active_searches = conn.execute("""
+        # new searches (without visibility checks yet) go first, then the ones with the oldest checks
+        stmt = sqlalchemy.text("""
             SELECT 
                 s3.* 
             FROM (
@@ -222,149 +292,184 @@ def update_visibility_for_list_of_active_searches(number_of_searches):
             WHERE 
                 f.folder_type IS NULL 
                 OR f.folder_type = 'searches' 
-            ORDER BY s3.timestamp 
-            /*action='get_full_list_of_active_searches 2.0' */
+            ORDER BY (s3.status IS NULL) DESC, s3.timestamp 
+            LIMIT :a 
+            /*action='get_full_list_of_active_searches 3.0' */
             ;
-            """).fetchall()
-
-        cleared_list_of_active_searches = []
-
-        # first we add new lines to the list
-        for line in full_list_of_active_searches:
-            search = list(line)
-            if not search[3]:
-                cleared_list_of_active_searches.append(search)
-
-        # then we add not-new lines that are not deleted
-        for line in full_list_of_active_searches:
-            search = list(line)
-            if search[3] and search[3] != 'deleted':
-                cleared_list_of_active_searches.append(search)
-                if len(cleared_list_of_active_searches) >= number_of_searches:
-                    break
+            """)
+        cleared_list_of_active_searches = conn.execute(stmt, a=number_of_searches).fetchall()
 
         if cleared_list_of_active_searches:
             logging.info(f'length of cleared list of active searches is {len(cleared_list_of_active_searches)}')
             logging.info(f'cleared list of active searches: {cleared_list_of_active_searches}')
 
+            contents, bad_gateway_counter = parse_searches([search[1] for search in cleared_list_of_active_searches],
+                                                           bad_gateway_counter, stop_on_bad_gateways=True)
+            list_of_visibilities = []
+
             for search in cleared_list_of_active_searches:
 
-                update_one_topic_visibility(search[1])
+                # pages, which were not requested due to bad gateways, are not in contents
+                if search[1] not in contents:
+                    break
+
+                visibility = get_one_topic_visibility(search[1], contents[search[1]])
+                if visibility:
+                    list_of_visibilities.append([search[1], visibility])
+                else:
+                    bad_gateway_counter += 1
+                    logging.info('502: {} - {}'.format(str(search[1]), bad_gateway_counter))
 
                 if bad_gateway_counter > 3:
                     break
 
+            update_topics_visibility(list_of_visibilities)
+
     except Exception as e:
         logging.info('exception in get_and_update_list_of_active_searches')
         logging.exception(e)
 
     conn.close()
-    pool.dispose()
 
-    return None
+    return bad_gateway_counter
 
 
 def parse_search(search_num):
-    """parse the whole search page"""
+    """parse the whole search page, returns content and a flag if the forum did not respond"""
 
-    global requests_session
-    global bad_gateway_counter
     content = None
+    bad_gateway = False
 
     try:
-        url = f'https://lizaalert.org/forum/viewtopic.php?t={search_num}'
-        r = requests_session.get(url, timeout=10)  # seconds – not sure if it is efficient in this case
+        r = requests_session.get(forum_topic_url, params={'t': search_num},
+                                 timeout=10)  # seconds – not sure if it is efficient in this case
         content = r.content.decode("utf-8")
 
     except requests.exceptions.ReadTimeout:
         logging.info(f'[che_posts]: requests.exceptions.ReadTimeout')
         notify_admin(f'[che_posts]: requests.exceptions.ReadTimeout')
-        bad_gateway_counter += 1
+        bad_gateway = True
 
     except requests.exceptions.Timeout:
         logging.info(f'[che_posts]: requests.exceptions.Timeout')
         notify_admin(f'[che_posts]: requests.exceptions.Timeout')
-        bad_gateway_counter += 1
+        bad_gateway = True
 
     except ConnectionError:
         logging.info(f'[che_posts]: CONNECTION ERROR OR TIMEOUT')
         notify_admin(f'[che_posts]: CONNECTION ERROR OR TIMEOUT')
-        bad_gateway_counter += 1
+        bad_gateway = True
 
     except Exception as e:
         logging.info('[che_posts]: Unknown exception')
         logging.exception(e)
 
-    return content
+    return content, bad_gateway
+
 
+def parse_searches(list_of_search_nums, bad_gateway_counter, stop_on_bad_gateways=False):
+    """parse the whole pages of several searches in parallel threads,
+    returns dict {search_num: content} and the updated number of bad gateways.
+    stop_on_bad_gateways – don't request the rest of pages once there were more than 3 bad gateways"""
 
-def parse_first_post(search_num):
+    contents = {}
+
+    with ThreadPoolExecutor(max_workers=max_parallel_requests) as executor:
+        for i in range(0, len(list_of_search_nums), max_parallel_requests):
+            batch = list_of_search_nums[i:(i + max_parallel_requests)]
+            for search_num, (content, bad_gateway) in zip(batch, executor.map(parse_search, batch)):
+                contents[search_num] = content
+                bad_gateway_counter += bad_gateway
+
+            # if forum is down – there's no need to request the rest of pages
+            if stop_on_bad_gateways and bad_gateway_counter > 3:
+                break
+
+    return contents, bad_gateway_counter
+
+
+def parse_first_post(search_num, content):
     """parse the first post of search"""
 
     hash_num = None
     bad_gateway = False
     not_found = False
 
-    content = parse_search(search_num)
-
     if content:
 
-        bad_gateway = True if content.find('502 Bad Gateway') > 0 else False
-        not_found = True if content.find('Запрошенной темы не существует') > 0 else False
+        markers = get_page_markers(content)
+        bad_gateway = '502 Bad Gateway' in markers
+        not_found = 'Запрошенной темы не существует' in markers
 
         if not bad_gateway and not not_found:
 
             get_status_from_content_and_send_to_topic_management(search_num, content)
 
+            # if some block is not found (e.g. the topic is visible only after login) – the page is cut the same way
+            # as it was by find() / rfind() returning -1, so that the hash of such page doesn't change
+
             # cut the wording of the first post
-            start = content.find('<div class="content">')
-            content = content[(start + 21):]
+            _, found, after = content.partition('<div class="content">')
+            content = after if found else content[20:]
 
             # find the next block and limit the content till this block
-            next_block = content.find('<div class="back2top">')
-            content = content[:(next_block - 12)]
+            before, found, _ = content.partition('<div class="back2top">')
+            content = content[:((len(before) if found else -1) - 12)]
 
             # cut out div closure
-            fin_div = content.rfind('</div>')
-            content = content[:fin_div]
+            before, found, _ = content.rpartition('</div>')
+            content = before if found else content[:-1]
 
             # cut blank symbols in the end of code
-            finish = content.rfind('>')
-            content = content[:(finish + 1)]
-
-            # exclude dynamic info – views of the pictures
-            patterns = re.findall(r'\) \d+ просмотр(?:а|ов)?', content)
-            if patterns:
-                for word in patterns:
-                    content = content.replace(word, ")")
-
-            # exclude dynamic info - token / creation time / sid / etc / footer
-            patterns_list = [r'value="\S{10}"',
-                             r'value="\S{32}"',
-                             r'value="\S{40}"',
-                             r'sid=\S{32}&amp;',
-                             r'<span class="footer-info"><span title="SQL time:.{120,130}</span></span>'
-                             ]
-
-            patterns = []
-            for pat in patterns_list:
-                patterns += re.findall(pat, content)
-
-            if patterns:
-                for word in patterns:
-                    content = content.replace(word, '')
+            content = content[:(content.rfind('>') + 1)]
+
+            # exclude dynamic info – views of the pictures, token / creation time / sid / etc / footer
+            content = pattern_dynamic_info.sub('', content)
 
             # craft a hash for this content
+            # md5 is kept intentionally: hashes are compared with the ones already saved in search_first_posts,
+            # so another algorithm would mark all the first posts as changed. The hash can't be calculated on the
+            # fly from the response either – it is made for the cut & scrubbed content only
             hash_num = hashlib.md5(content.encode()).hexdigest()
 
     return hash_num, content, bad_gateway, not_found
 
 
+def select_searches_by_weights(base_table, percent_of_searches, weights):
+    """pick the searches from the table of their positions in every sorting, each sorting gives its share.
+    base_table: [[search_id, position_1, position_2, position_3, position_4, position_5, number_of_active_searches]]"""
+
+    outcome_list = []
+    num_of_searches = round(base_table[0][6] * percent_of_searches / 100) if base_table else 0
+
+    # for every parameter the searches are taken by their position in the sorted list:
+    # number 1 – should be the first to check
+    # number ∞ – should be the last to check
+    # 1. search_start_time – the latest searches first
+    # 2. search_update_time – the oldest updates first
+    # 3. folder weight – the most popular folders first
+    # 4. number of check that were already done – the fewest checks first
+    # 5. random
+    selected_ids = set()
+    for column, weight in enumerate(["start_time", "upd_time", "folder_weight", "checks_made", "random"], 1):
+
+        group_of_searches = round(weights[weight] / 100 * num_of_searches)
+
+        for search in sorted(base_table, key=lambda x: x[column]):
+            if search[0] not in selected_ids and group_of_searches > 0:
+                outcome_list.append(search)
+                selected_ids.add(search[0])
+                group_of_searches -= 1
+            elif group_of_searches == 0:
+                break
+
+    return outcome_list
+
+
 def get_list_of_searches_for_first_post_and_status_update(percent_of_searches, weights):
     """get best list of searches for which first posts should be checked"""
 
     outcome_list = []
-    base_table = []
 
     # there are five types of search parameters:
     # 1. search_start_time
@@ -376,174 +481,105 @@ def get_list_of_searches_for_first_post_and_status_update(percent_of_searches, w
 
     if percent_of_searches > 0:
 
-        pool = sql_connect()
-        conn = pool.connect()
+        conn = sql_connect().connect()
 
         try:
             # get the data from sql with the structure:
-            # [search_id, search_start_time, forum_folder_id, search_update_time, number_of_searches_in_folder]
+            # [search_id, position_1, position_2, position_3, position_4, position_5, number_of_active_searches]
+            # position_N – is a position of search in the list of all active searches sorted by the N-th parameter
+            # (every next sorting keeps the order of the previous one for equal values).
             # search_update_time – is a time of search's first post actualization in SQL
             # number_of_searches_in_folder – is a historical number of searches in SQL assigned to each folder
-            raw_sql_extract = conn.execute("""
+            # only searches, which are high enough in at least one sorting to be picked, are returned:
+            # every group takes its share of searches, skipping the ones already taken by previous groups,
+            # so no group goes deeper in its sorting than the sum of all the shares. Each share is rounded
+            # by at most 0.5, as well as the number of searches to be checked – hence the margins below
+            stmt = sqlalchemy.text("""
             SELECT 
-                s4.*, s5.count 
+                s7.* 
             FROM (
                 SELECT 
-                    s2.*, s3.timestamp, s3.num_of_checks
+                    s6.search_forum_num, 
+                    row_number() OVER (ORDER BY s6.search_start_time DESC NULLS LAST) AS pos_start_time, 
+                    row_number() OVER (ORDER BY s6.timestamp NULLS FIRST, s6.search_start_time DESC NULLS LAST) 
+                        AS pos_upd_time, 
+                    row_number() OVER (ORDER BY s6.count DESC NULLS LAST, s6.timestamp NULLS FIRST, 
+                        s6.search_start_time DESC NULLS LAST) AS pos_folder_weight, 
+                    row_number() OVER (ORDER BY COALESCE(NULLIF(s6.num_of_checks, 0), 1), s6.count DESC NULLS LAST, 
+                        s6.timestamp NULLS FIRST, s6.search_start_time DESC NULLS LAST) AS pos_checks_made, 
+                    row_number() OVER (ORDER BY random()) AS pos_random, 
+                    count(*) OVER () AS num_of_active_searches 
                 FROM (
                     SELECT 
-                        s0.search_forum_num, s0.search_start_time, s0.forum_folder_id 
+                        s4.*, s5.count 
                     FROM (
                         SELECT 
-                            search_forum_num, search_start_time, forum_folder_id
+                            s2.*, s3.timestamp, s3.num_of_checks
+                        FROM (
+                            SELECT 
+                                s0.search_forum_num, s0.search_start_time, s0.forum_folder_id 
+                            FROM (
+                                SELECT 
+                                    search_forum_num, search_start_time, forum_folder_id
+                                FROM
+                                    searches 
+                                WHERE
+                                    status_short = 'Ищем'
+                            ) s0 
+                            LEFT JOIN 
+                                search_health_check s1 
+                            ON 
+                                s0.search_forum_num=s1.search_forum_num 
+                            WHERE
+                                (s1.status != 'deleted' AND s1.status != 'hidden')
+                        ) s2 
+                        LEFT JOIN 
+                        (
+                        SELECT 
+                            search_id, timestamp, actual, content_hash, num_of_checks 
                         FROM
-                            searches 
+                            search_first_posts 
                         WHERE
-                            status_short = 'Ищем'
-                    ) s0 
+                            actual=TRUE
+                        ) s3 
+                        ON
+                            s2.search_forum_num=s3.search_id
+                    ) s4 
                     LEFT JOIN 
-                        search_health_check s1 
+                    (
+                        SELECT
+                            count(*), forum_folder_id
+                        FROM
+                            searches
+                        GROUP BY
+                            forum_folder_id
+                    ) s5 
                     ON 
-                        s0.search_forum_num=s1.search_forum_num 
-                    WHERE
-                        (s1.status != 'deleted' AND s1.status != 'hidden')
-                ) s2 
-                LEFT JOIN 
-                (
-                SELECT 
-                    search_id, timestamp, actual, content_hash, num_of_checks 
-                FROM
-                    search_first_posts 
-                WHERE
-                    actual=TRUE
-                ) s3 
-                ON
-                    s2.search_forum_num=s3.search_id
-            ) s4 
-            LEFT JOIN 
-            (
-                SELECT
-                    count(*), forum_folder_id
-                FROM
-                    searches
-                GROUP BY
-                    forum_folder_id
-                ORDER BY
-                    count(*) DESC
-            ) s5 
-            ON 
-                s4.forum_folder_id=s5.forum_folder_id
-            LEFT JOIN
-                folders AS f
-            ON
-                s4.forum_folder_id = f.folder_id
+                        s4.forum_folder_id=s5.forum_folder_id
+                    LEFT JOIN
+                        folders AS f
+                    ON
+                        s4.forum_folder_id = f.folder_id
+                    WHERE 
+                        f.folder_type IS NULL OR f.folder_type = 'searches'
+                ) s6 
+            ) s7 
             WHERE 
-                f.folder_type IS NULL OR f.folder_type = 'searches'
-            /*action='get_list_of_searches_for_first_post_and_status_update 2.0' */        
+                LEAST(pos_start_time, pos_upd_time, pos_folder_weight, pos_checks_made, pos_random) 
+                <= CEIL((num_of_active_searches * :a / 100.0 + 0.5) * :b / 100.0 + :c) 
+            /*action='get_list_of_searches_for_first_post_and_status_update 3.0' */        
             ;
-            """).fetchall()
-
-            # form the list-like table
-            if raw_sql_extract:
-                for line in raw_sql_extract:
-                    new_line = [line[0], line[1], line[3], line[5], line[4]]
-                    # for blank lines we paste the oldest date
-                    if not line[3]:
-                        new_line[2] = datetime.datetime(1, 1, 1, 0, 0)
-                    # for blank lines we paste the oldest date
-                    if not line[4]:
-                        new_line[4] = 1
-                    base_table.append(new_line)
-
-            num_of_searches = round(len(base_table) * percent_of_searches / 100)
-
-            # 1. sort the table by 1st arg = search_start_time
-            # number 1 – should be the first to check,
-            # number ∞ – should be the last to check
-            base_table.sort(key=lambda x: x[1], reverse=True)
-            i = 1
-            for line in base_table:
-                line.append(i)
-                i += 1
-
-            group_of_searches = round(weights["start_time"]/100*num_of_searches)
-
-            for j in range(group_of_searches):
-                outcome_list.append(base_table[j])
-
-            # 2. sort the table by 2nd arg = search_update_time
-            # number 1 – should be the first to check
-            # number ∞ – should be the last to check
-            base_table.sort(key=lambda x: x[2])
-            i = 1
-            for line in base_table:
-                line.append(i)
-                i += 1
-
-            group_of_searches = round(weights["upd_time"] / 100 * num_of_searches)
-
-            for j in range(len(base_table)):
-                if base_table[j][0] not in [line[0] for line in outcome_list] and group_of_searches > 0:
-                    outcome_list.append(base_table[j])
-                    group_of_searches -= 1
-                elif group_of_searches == 0:
-                    break
-
-            # 3. sort the table by 3rd arg = folder weight
-            # number 1 – should be the first to check
-            # number ∞ – should be the last to check
-            base_table.sort(key=lambda x: x[3], reverse=True)
-            i = 1
-            for line in base_table:
-                line.append(i)
-                i += 1
-
-            group_of_searches = round(weights["folder_weight"] / 100 * num_of_searches)
-
-            for j in range(len(base_table)):
-                if base_table[j][0] not in [line[0] for line in outcome_list] and group_of_searches > 0:
-                    outcome_list.append(base_table[j])
-                    group_of_searches -= 1
-                elif group_of_searches == 0:
-                    break
-
-            # 4. sort the table by 4th arg = number of check that were already done
-            # number 1 – should be the first to check
-            # number ∞ – should be the last to check
-            base_table.sort(key=lambda x: x[4])
-            i = 1
-            for line in base_table:
-                line.append(i)
-                i += 1
-
-            group_of_searches = round(weights["checks_made"] / 100 * num_of_searches)
-
-            for j in range(len(base_table)):
-                if base_table[j][0] not in [line[0] for line in outcome_list] and group_of_searches > 0:
-                    outcome_list.append(base_table[j])
-                    group_of_searches -= 1
-                elif group_of_searches == 0:
-                    break
-
-            # 5. get random searches for checks
-
-            random.shuffle(base_table)
+            """)
+            base_table = conn.execute(stmt, a=percent_of_searches, b=sum(weights.values()),
+                                      c=len(weights) / 2).fetchall()
 
-            group_of_searches = round(weights["random"] / 100 * num_of_searches)
-
-            for j in range(len(base_table)):
-                if base_table[j][0] not in [line[0] for line in outcome_list] and group_of_searches > 0:
-                    outcome_list.append(base_table[j])
-                    group_of_searches -= 1
-                elif group_of_searches == 0:
-                    break
+            outcome_list = select_searches_by_weights(base_table, percent_of_searches, weights)
 
         except Exception as e:
             logging.info('exception in get_list_of_searches_for_first_post_update')
             logging.exception(e)
 
         conn.close()
-        pool.dispose()
 
     return outcome_list
 
@@ -551,13 +587,20 @@ def get_list_of_searches_for_first_post_and_status_update(percent_of_searches, w
 def get_the_diff_between_strings(string_1, string_2):
     """get the text-message with the difference of two strings"""
 
-    comparison = list(difflib.Differ().compare(string_1.splitlines(), string_2.splitlines()))
+    lines_1 = string_1.splitlines()
+    lines_2 = string_2.splitlines()
 
+    # only added / deleted lines are needed, so line-level opcodes are enough
+    # (difflib.Differ also makes char-level comparison of the changed lines, which is much slower)
     output_message = ''
 
-    for line in comparison:
-        if line[0] in {'+', '-'}:
-            output_message += line + '\n'
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, lines_1, lines_2).get_opcodes():
+        if tag in {'delete', 'replace'}:
+            for line in lines_1[i1:i2]:
+                output_message += '- ' + line + '\n'
+        if tag in {'insert', 'replace'}:
+            for line in lines_2[j1:j2]:
+                output_message += '+ ' + line + '\n'
 
     return output_message
 
@@ -566,27 +609,20 @@ def get_status_from_content_and_send_to_topic_management(topic_id, act_content):
     """block to check if Status of the search has changed – if so send a pub/sub to topic_management"""
 
     # get the Title out of page content (intentionally avoid BS4 to make pack slimmer)
-    pre_title = re.search(r'<h2 class="topic-title"><a href=.{1,500}</a>', act_content)
+    pre_title = pattern_pre_title.search(act_content)
     pre_title = pre_title.group() if pre_title else None
-    pre_title = re.search(r'">.{1,500}</a>', pre_title[32:]) if pre_title else None
+    pre_title = pattern_title.search(pre_title[32:]) if pre_title else None
     title = pre_title.group()[2:-4] if pre_title else None
     status = None
     if title:
-        missed = re.search(r'(?i).{0,10}пропал.*', title) if title else None
-        if missed:
+        if pattern_status_missed.search(title):
             status = 'Ищем'
-        else:
-            missed = re.search(r'(?i).{0,10}(?:найден|).{0,5}жив', title)
-            if missed:
-                status = 'НЖ'
-            else:
-                missed = re.search(r'(?i).{0,10}(?:найден|).{0,5}пог', title)
-                if missed:
-                    status = 'НП'
-                else:
-                    missed = re.search(r'(?i).{0,10}заверш.н', title)
-                    if missed:
-                        status = 'Завершен'
+        elif pattern_status_alive.search(title):
+            status = 'НЖ'
+        elif pattern_status_dead.search(title):
+            status = 'НП'
+        elif pattern_status_finished.search(title):
+            status = 'Завершен'
 
     if status in {'НЖ', 'НП', 'Завершен'}:
         publish_to_pubsub('topic_for_topic_management', {'topic_id': topic_id, 'status': status})
@@ -596,122 +632,146 @@ def get_status_from_content_and_send_to_topic_management(topic_id, act_content):
 
 
 def update_first_posts_and_statuses(percent_of_searches, weights):
-    """periodically check if the first post of searches"""
-
-    global bad_gateway_counter
-    global requests_session
+    """periodically check if the first post of searches, returns the number of bad gateways"""
 
+    bad_gateway_counter = 0
     list_of_searches_with_updated_first_posts = []
     list_of_searches = get_list_of_searches_for_first_post_and_status_update(percent_of_searches, weights)
 
     if list_of_searches:
 
-        pool = sql_connect()
-        conn = pool.connect()
+        contents, bad_gateway_counter = parse_searches([line[0] for line in list_of_searches], bad_gateway_counter)
 
-        try:
-            for line in list_of_searches:
-
-                search_id = line[0]
-                act_hash, act_content, bad_gateway_trigger, not_found_trigger = parse_first_post(search_id)
-
-                if not bad_gateway_trigger and not not_found_trigger:
-
-                    # check the latest hash
-                    stmt = sqlalchemy.text("""
-                    SELECT content_hash, num_of_checks, content from search_first_posts WHERE search_id=:a 
-                    AND actual = TRUE;
-                    """)
-                    raw_data = conn.execute(stmt, a=search_id).fetchone()
-
-                    # if record for this search – exists
-                    if raw_data:
-
-                        last_hash = raw_data[0]
-                        prev_number_of_checks = raw_data[1]
-                        # last_content = raw_data[2]
-
-                        if not prev_number_of_checks:
-                            prev_number_of_checks = 1
-
-                        # if record for this search – outdated
-                        if act_hash != last_hash:
-
-                            # set all prev records as Actual = False
-                            stmt = sqlalchemy.text("""
-                            UPDATE search_first_posts SET actual = FALSE WHERE search_id = :a;
-                            """)
-                            conn.execute(stmt, a=search_id)
-
-                            # add new record
-                            stmt = sqlalchemy.text("""
-                            INSERT INTO search_first_posts 
-                            (search_id, timestamp, actual, content_hash, content, num_of_checks) 
-                            VALUES (:a, :b, TRUE, :c, :d, :e);
-                            """)
-                            conn.execute(stmt, a=search_id, b=datetime.datetime.now(), c=act_hash,
-                                         d=act_content, e=1)
-
-                            # add the search into the list of searches to be sent to pub/sub
-                            list_of_searches_with_updated_first_posts.append(search_id)
-
-                        # if record for this search – actual
-                        else:
-
-                            # update the number of checks for this search
-                            stmt = sqlalchemy.text("""
-                                                UPDATE 
-                                                    search_first_posts 
-                                                SET 
-                                                    num_of_checks = :a 
-                                                WHERE 
-                                                    search_id = :b AND actual = True;
-                                                """)
-                            conn.execute(stmt, a=(prev_number_of_checks + 1), b=search_id)
-
-                    # if record for this search – does not exist – add a new record
-                    else:
-
-                        stmt = sqlalchemy.text("""
-                                                INSERT INTO search_first_posts 
-                                                (search_id, timestamp, actual, content_hash, content, num_of_checks) 
-                                                VALUES (:a, :b, TRUE, :c, :d, :e);
-                                                """)
-                        conn.execute(stmt, a=search_id, b=datetime.datetime.now(), c=act_hash, d=act_content, e=1)
-
-                elif bad_gateway_trigger:
+        # parse all the first posts before going to psql: {search_id: [hash, content]}
+        first_posts = {}
+        list_of_visibilities = []
+
+        for line in list_of_searches:
+
+            search_id = line[0]
+
+            act_hash, act_content, bad_gateway_trigger, not_found_trigger = \
+                parse_first_post(search_id, contents[search_id])
+
+            if not bad_gateway_trigger and not not_found_trigger:
+                first_posts[search_id] = [act_hash, act_content]
+
+            elif bad_gateway_trigger:
+                bad_gateway_counter += 1
+                logging.info('502: {} - {}'.format(search_id, bad_gateway_counter))
+
+            elif not_found_trigger:
+                # for not found searches act_content is the whole page
+                visibility = get_one_topic_visibility(search_id, act_content)
+                if visibility:
+                    list_of_visibilities.append([search_id, visibility])
+                else:
                     bad_gateway_counter += 1
-                    logging.info('502: {} - {}'.format(search_id, bad_gateway_counter))
 
-                elif not_found_trigger:
-                    update_one_topic_visibility(search_id)
+        update_topics_visibility(list_of_visibilities)
 
-        except Exception as e:
-            logging.info('exception in update_first_posts_and_statuses')
-            logging.exception(e)
+        if first_posts:
 
-        conn.close()
-        pool.dispose()
+            conn = sql_connect().connect()
+
+            try:
+                # the latest hashes are checked and all the changes are saved by one statement:
+                # changed first posts – all prev records are set as Actual = False & new record is added,
+                # not changed first posts – the number of checks is updated,
+                # searches without any records – a new record is added.
+                # Searches with changed first posts (but not the new ones) are returned.
+                # The statement starts with WITH – so SQLAlchemy should be told to commit it
+                stmt = sqlalchemy.text("""
+                WITH new_posts AS (
+                    SELECT * FROM unnest(:a, :c, :d) AS v (search_id, content_hash, content)
+                ), 
+                old_posts AS (
+                    SELECT 
+                        s.search_id, s.content_hash, s.num_of_checks 
+                    FROM 
+                        search_first_posts s 
+                    JOIN 
+                        new_posts n 
+                    ON 
+                        s.search_id = n.search_id 
+                    WHERE 
+                        s.actual = TRUE
+                ), 
+                changed AS (
+                    SELECT 
+                        o.search_id 
+                    FROM 
+                        old_posts o 
+                    JOIN 
+                        new_posts n 
+                    ON 
+                        o.search_id = n.search_id 
+                    WHERE 
+                        o.content_hash IS DISTINCT FROM n.content_hash
+                ), 
+                deactivated AS (
+                    UPDATE search_first_posts SET actual = FALSE WHERE search_id IN (SELECT search_id FROM changed)
+                ), 
+                checked AS (
+                    UPDATE 
+                        search_first_posts s 
+                    SET 
+                        num_of_checks = COALESCE(NULLIF(o.num_of_checks, 0), 1) + 1 
+                    FROM 
+                        old_posts o 
+                    WHERE 
+                        s.search_id = o.search_id AND s.actual = TRUE 
+                        AND o.search_id NOT IN (SELECT search_id FROM changed)
+                ), 
+                inserted AS (
+                    INSERT INTO search_first_posts 
+                    (search_id, timestamp, actual, content_hash, content, num_of_checks) 
+                    SELECT 
+                        n.search_id, :b, TRUE, n.content_hash, n.content, 1 
+                    FROM 
+                        new_posts n 
+                    WHERE 
+                        n.search_id IN (SELECT search_id FROM changed) 
+                        OR n.search_id NOT IN (SELECT search_id FROM old_posts)
+                )
+                SELECT search_id FROM changed;
+                """).execution_options(autocommit=True)
+                search_ids = list(first_posts.keys())
+                updated_search_ids = {line[0] for line in conn.execute(
+                    stmt,
+                    a=search_ids,
+                    b=datetime.datetime.now(),
+                    c=[first_posts[search_id][0] for search_id in search_ids],
+                    d=[first_posts[search_id][1] for search_id in search_ids])}
+
+                # add the searches into the list of searches to be sent to pub/sub
+                list_of_searches_with_updated_first_posts = [search_id for search_id in search_ids
+                                                             if search_id in updated_search_ids]
+
+            except Exception as e:
+                logging.info('exception in update_first_posts_and_statuses')
+                logging.exception(e)
+                # nothing was saved – so nothing should be sent further
+                list_of_searches_with_updated_first_posts = []
+
+            conn.close()
 
     if list_of_searches_with_updated_first_posts:
         # send pub/sub message on the updated first page
         publish_to_pubsub('topic_for_first_post_processing', list_of_searches_with_updated_first_posts)
 
-    return None
+    return bad_gateway_counter
 
 
 def main(event, context): # noqa
     """main function"""
 
-    global bad_gateway_counter
-    bad_gateway_counter = 0
-
     # BLOCK 1. for checking visibility (deleted or hidden) and status (Ищем, НЖ, НП) changes of active searches
     # A reason why this functionality – is in this script, is that it worth update the list of active searches first
     # and then check for first posts. Plus, once first posts checker finds something odd – it triggers a visibility
     # check for this search
     number_of_checked_searches = 100
-    update_visibility_for_list_of_active_searches(number_of_checked_searches)
+    bad_gateways_of_visibility = update_visibility_for_list_of_active_searches(number_of_checked_searches)
 
     # BLOCK 2. for checking if the first posts were changed
     # check is made for a certain % from the full list of active searches
@@ -727,11 +787,16 @@ def main(event, context): # noqa
     # 4. checks_made – will help to check only searches with fewer previous checks
     # 5. random – turned out a good solution to check other searches that don't fall into prev categories
     weights = {"start_time": 20, "upd_time": 20, "folder_weight": 20, "checks_made": 20, "random": 20}
-    update_first_posts_and_statuses(percent_of_first_posts_to_check, weights)
+    bad_gateways_of_first_posts = update_first_posts_and_statuses(percent_of_first_posts_to_check, weights)
 
+    # each block counts its own bad gateways – the first posts are checked even if visibility check stopped early
+    bad_gateway_counter = bad_gateways_of_visibility + bad_gateways_of_first_posts
     if bad_gateway_counter > 3:
         publish_to_pubsub('topic_notify_admin', f'[che_posts]: Bad Gateway {bad_gateway_counter} times')
 
+    # Cloud Function should not finish before all the messages are sent
+    wait_for_published_messages()
+
     # Close the open session
     requests_session.close()
 
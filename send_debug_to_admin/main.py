@@ -4,7 +4,9 @@ To receive notifications one should be marked as Admin in PSQL"""
 import datetime
 import os
 import base64
+import json
 import logging
+import functools
 
 from telegram import Bot
 
@@ -18,8 +20,9 @@ logging.getLogger("telegram.vendor.ptb_urllib3.urllib3").setLevel(logging.ERROR)
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=16)
 def get_secrets(secret_request):
-    """get google cloud secret"""
+    """get google cloud secret, cached for the lifetime of the instance"""
 
     name = f"projects/{project_id}/secrets/{secret_request}/versions/latest"
     response = client.access_secret_version(name=name)
@@ -27,13 +30,21 @@ def get_secrets(secret_request):
     return response.payload.data.decode("UTF-8")
 
 
-def process_pubsub_message(event):
-    """get the text message from pubsub"""
+@functools.lru_cache(maxsize=1)
+def get_bot():
+    """create the debug telegram bot once per instance"""
+
+    bot_token_debug = get_secrets("bot_api_token")
+
+    return Bot(token=bot_token_debug)
+
+
+def process_pubsub_message(received_message_from_pubsub):
+    """get the text message from the already decoded pubsub payload"""
 
     # receiving message text from pub/sub
-    if 'data' in event:
-        received_message_from_pubsub = base64.b64decode(event['data']).decode('utf-8')
-        encoded_to_ascii = eval(received_message_from_pubsub)
+    if received_message_from_pubsub is not None:
+        encoded_to_ascii = json.loads(received_message_from_pubsub)
         data_in_ascii = encoded_to_ascii['data']
         message_in_ascii = data_in_ascii['message']
     else:
@@ -47,9 +58,8 @@ def send_message(admin_user_id, message, bot):
 
     try:
 
-        # to avoid 4000 symbols restriction for telegram message
-        if len(message) > 3500:
-            message = message[:1500]
+        # to avoid 4096 symbols restriction for telegram message, slicing a short message is a cheap no-op
+        message = message[:4000]
 
         bot.sendMessage(chat_id=admin_user_id, text=message)
 
@@ -70,15 +80,13 @@ def send_message(admin_user_id, message, bot):
 def main(event, context): # noqa
     """main function, envoked by pub/sub, which sends the notification to Admin""" # noqa
 
-    pubsub_message = base64.b64decode(event['data']).decode('utf-8')
-    logging.info('[send_debug]: received from pubsub: {}'.format(pubsub_message)) # noqa
+    pubsub_message = base64.b64decode(event['data']).decode('utf-8') if 'data' in event else None
+    logging.info('[send_debug]: received from pubsub: %s', pubsub_message)
 
-    message_from_pubsub = process_pubsub_message(event)
+    message_from_pubsub = process_pubsub_message(pubsub_message)
 
     admin_user_id = get_secrets("my_telegram_id")
-    bot_token_debug = get_secrets("bot_api_token")
-
-    bot = Bot(token=bot_token_debug)
+    bot = get_bot()
 
     send_message(admin_user_id, message_from_pubsub, bot)
 
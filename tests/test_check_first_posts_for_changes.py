@@ -0,0 +1,92 @@
+"""Selection of searches for the first posts check: the SQL pre-filter should not change the outcome"""
+
+import importlib.util
+import math
+import os
+import random
+import unittest
+
+
+def load_script():
+    """import main.py of the cloud function, which needs its own dependencies installed"""
+
+    os.environ.setdefault('GCP_PROJECT', 'test')
+    path = os.path.join(os.path.dirname(__file__), '..', 'check_first_posts_for_changes', 'main.py')
+    spec = importlib.util.spec_from_file_location('check_first_posts_for_changes_main', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+try:
+    script = load_script()
+except Exception:  # noqa
+    script = None
+
+
+def baseline_selection(base_table, percent_of_searches, weights):
+    """selection as it was done over the whole table of active searches, before the SQL pre-filter"""
+
+    num_of_searches = round(len(base_table) * percent_of_searches / 100)
+    outcome_list = []
+    for column, weight in enumerate(["start_time", "upd_time", "folder_weight", "checks_made", "random"], 1):
+        group_of_searches = round(weights[weight] / 100 * num_of_searches)
+        for line in sorted(base_table, key=lambda x: x[column]):
+            if line[0] not in [selected[0] for selected in outcome_list] and group_of_searches > 0:
+                outcome_list.append(line)
+                group_of_searches -= 1
+            elif group_of_searches == 0:
+                break
+
+    return outcome_list
+
+
+def sql_prefilter(base_table, percent_of_searches, weights):
+    """the same WHERE clause as in get_list_of_searches_for_first_post_and_status_update"""
+
+    cap = math.ceil((len(base_table) * percent_of_searches / 100.0 + 0.5) * sum(weights.values()) / 100.0
+                    + len(weights) / 2)
+
+    return [line for line in base_table if min(line[1:6]) <= cap]
+
+
+def make_table(num_of_active_searches, seed):
+    """table of searches with their positions in five sortings: independent for odd seeds, the same for even ones –
+    then every next group has to skip all the searches taken by the previous groups and goes the deepest"""
+
+    rnd = random.Random(seed)
+    positions = []
+    for _ in range(5):
+        order = list(range(1, num_of_active_searches + 1))
+        rnd.shuffle(order)
+        positions.append(order if seed % 2 or not positions else positions[0])
+
+    return [[10000 + i] + [positions[j][i] for j in range(5)] + [num_of_active_searches]
+            for i in range(num_of_active_searches)]
+
+
+@unittest.skipIf(script is None, 'dependencies of check_first_posts_for_changes are not installed')
+class TestSelectSearchesByWeights(unittest.TestCase):
+
+    def test_prefilter_keeps_the_baseline_selection(self):
+        list_of_weights = [
+            {"start_time": 20, "upd_time": 20, "folder_weight": 20, "checks_made": 20, "random": 20},
+            {"start_time": 50, "upd_time": 10, "folder_weight": 15, "checks_made": 5, "random": 20},
+            {"start_time": 70, "upd_time": 30, "folder_weight": 0, "checks_made": 0, "random": 0},
+            {"start_time": 3, "upd_time": 3, "folder_weight": 3, "checks_made": 3, "random": 88},
+        ]
+        for weights in list_of_weights:
+            for num_of_active_searches in (1, 2, 3, 7, 13, 40, 101):
+                for percent_of_searches in (1, 10, 17, 35, 50, 100):
+                    for seed in range(4):
+                        with self.subTest(weights=weights, n=num_of_active_searches, p=percent_of_searches):
+                            base_table = make_table(num_of_active_searches, seed)
+                            expected = baseline_selection(base_table, percent_of_searches, weights)
+                            prefiltered = sql_prefilter(base_table, percent_of_searches, weights)
+                            outcome = script.select_searches_by_weights(prefiltered, percent_of_searches, weights)
+                            self.assertEqual([line[0] for line in outcome], [line[0] for line in expected])
+
+
+if __name__ == '__main__':
+    unittest.main()
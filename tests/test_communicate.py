@@ -0,0 +1,73 @@
+"""Saving of user's notification preferences, run against a scratch Postgres given by TEST_PSQL_DSN"""
+
+import importlib.util
+import os
+import unittest
+
+
+def load_script():
+    """import main.py of the cloud function, which needs its own dependencies installed"""
+
+    os.environ.setdefault('GCP_PROJECT', 'test')
+    path = os.path.join(os.path.dirname(__file__), '..', 'communicate', 'main.py')
+    spec = importlib.util.spec_from_file_location('communicate_main', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+try:
+    script = load_script()
+    import psycopg2
+except Exception:  # noqa
+    script = None
+
+psql_dsn = os.environ.get('TEST_PSQL_DSN')
+
+
+@unittest.skipIf(script is None, 'dependencies of communicate are not installed')
+@unittest.skipIf(not psql_dsn, 'TEST_PSQL_DSN with a scratch Postgres database is not set')
+class TestSavePreference(unittest.TestCase):
+
+    user_id = 1
+
+    def setUp(self):
+        self.conn = psycopg2.connect(psql_dsn)
+        self.cur = self.conn.cursor()
+        # temporary table hides the real one, if any, and is dropped with the connection
+        self.cur.execute("""CREATE TEMP TABLE user_preferences (id SERIAL PRIMARY KEY, user_id BIGINT,
+                         preference VARCHAR, pref_id INTEGER, UNIQUE (user_id, pref_id));""")
+
+    def tearDown(self):
+        self.conn.rollback()
+        self.conn.close()
+
+    def saved_preferences(self):
+        self.cur.execute("""SELECT preference FROM user_preferences WHERE user_id=%s ORDER BY preference;""",
+                         (self.user_id,))
+        return [line[0] for line in self.cur.fetchall()]
+
+    def script_save(self, preference):
+        return script.save_preference(self.cur, self.user_id, preference)
+
+    def test_already_enabled_preference_is_saved_again(self):
+        for preference in ('all', 'new_searches', 'status_changes', 'comments_changes', 'inforg_comments',
+                           'bot_news', 'field_trips_new', 'field_trips_change', 'coords_change'):
+            with self.subTest(preference=preference):
+                self.cur.execute("""DELETE FROM user_preferences;""")
+                first = self.script_save(preference)
+                second = self.script_save(preference)
+                self.assertEqual(second, first)
+                self.assertEqual(self.saved_preferences(), second)
+
+    def test_replaced_preferences_are_deleted(self):
+        self.script_save('all')
+        self.assertEqual(self.script_save('new_searches'), ['bot_news', 'new_searches'])
+        self.assertEqual(self.script_save('new_searches'), ['bot_news', 'new_searches'])
+        self.assertEqual(self.script_save('-all'), ['bot_news'])
+        self.assertEqual(self.saved_preferences(), ['bot_news'])
+
+
+if __name__ == '__main__':
+    unittest.main()